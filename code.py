@@ -2,14 +2,22 @@ import sys
 print(sys.executable)
 
 import streamlit as st
+import numpy as np
 import pandas as pd
+import asyncio
+import httpx
 import base64
-import requests
-import xml.etree.ElementTree as ET
-from html import unescape
-from bs4 import BeautifulSoup
+import csv
+import gzip
+import io
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import re
+from diskcache import Cache
+from lxml import etree
 import textwrap
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 import os
 
 # Set Streamlit page config
@@ -44,11 +52,30 @@ URL = "https://cdr.ffiec.gov/public/pws/webservices/retrievalservice.asmx"
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:124.0) Gecko/20100101 Firefox/124.0",
     "Content-Type": "application/soap+xml; charset=utf-8",
-    "SOAPAction": "http://cdr.ffiec.gov/public/services/RetrieveFacsimile"
+    "SOAPAction": "http://cdr.ffiec.gov/public/services/RetrieveFacsimile",
+    # Multi-MB XBRL responses compress 5-10x; the client decompresses
+    # transparently.
+    "Accept-Encoding": "gzip, deflate"
 }
 
-def make_soap_body(rssd_id: int, period_end_date: str, username: str, passphrase: str) -> str:
-    raw = f"""<?xml version="1.0" encoding="utf-8"?>
+# Cap on concurrent in-flight SOAP requests (and on pooled connections),
+# so large ID lists don't hammer the FFIEC endpoint.
+MAX_CONCURRENCY = 16
+
+# The base64 payload sits in a single unique tag, so it can be pulled
+# straight out of the response bytes without building a DOM for the
+# (potentially multi-MB) SOAP envelope.
+_B64_RE = re.compile(rb"<RetrieveFacsimileResult[^>]*>([A-Za-z0-9+/=\s]+)</RetrieveFacsimileResult>")
+
+# Disk-backed response cache: call reports for a filed period never
+# change, so repeat runs -- including across process restarts -- skip the
+# network entirely. Bounded at 1 GiB with LRU eviction.
+_CACHE = Cache(".ffiec_cache", size_limit=2**30)
+
+# Dedented once at import time; make_soap_body only substitutes the four
+# variable fields instead of re-running textwrap.dedent on every call.
+SOAP_TEMPLATE = textwrap.dedent("""\
+    <?xml version="1.0" encoding="utf-8"?>
     <soap12:Envelope xmlns:soap12="http://schemas.xmlsoap.org/soap/envelope/">
         <soap12:Header>
             <wsa:Action>http://cdr.ffiec.gov/public/services/RetrieveFacsimile</wsa:Action>
@@ -69,59 +96,141 @@ def make_soap_body(rssd_id: int, period_end_date: str, username: str, passphrase
                 <facsimileFormat>XBRL</facsimileFormat>
             </RetrieveFacsimile>
         </soap12:Body>
-    </soap12:Envelope>"""
-    return textwrap.dedent(raw).strip()
-
-def fetch_facsimile(url: str, headers: dict, body: str) -> requests.Response:
-    response = requests.post(url, data=body, headers=headers)
-    response.raise_for_status()
-    return response
-
-def parse_xbrl_to_dataframe(content: str, rssd_id: str) -> pd.DataFrame:
-    content = unescape(content)
-    soup = BeautifulSoup(content, "xml")
-    xbrl_tag = soup.find("xbrl")
-    if not xbrl_tag:
-        raise ValueError("No <xbrl> element found in the file!")
-    records = []
-    for tag in xbrl_tag.find_all():
-        if tag.has_attr("decimals"):
-            fact_id = tag.name.split(":")[-1]
-            records.append({
-                "rssd_id": rssd_id,
-                "id": fact_id,
-                "value": tag.get_text(strip=True),
-                "decimal": tag["decimals"]
-            })
-    return pd.DataFrame(records)
+    </soap12:Envelope>""")
+
+def make_soap_body(rssd_id: int, period_end_date: str, username: str, passphrase: str) -> str:
+    return SOAP_TEMPLATE.format(rssd_id=rssd_id, period_end_date=period_end_date,
+                                username=username, passphrase=passphrase)
+
+async def _fetch_one(client: httpx.AsyncClient, sem: asyncio.Semaphore, rssd_id: str,
+                     period_end_date: str, username: str, passphrase: str) -> bytes:
+    # Returns the decoded XBRL bytes for one RSSD ID, or None when the
+    # endpoint has no data for it. Cached reports skip the network.
+    cache_key = f"{rssd_id}:{period_end_date}"
+    cached = _CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+    soap_body = make_soap_body(int(rssd_id), period_end_date, username, passphrase)
+    # Send the envelope gzipped; if the gateway rejects the compressed
+    # body with 415, fall back to the plain envelope for this request.
+    body = gzip.compress(soap_body.encode("utf-8"))
+    headers = {**HEADERS, "Content-Encoding": "gzip"}
+    async with sem:
+        for attempt in range(3):
+            response = await client.post(URL, content=body, headers=headers)
+            if response.status_code == 415 and "Content-Encoding" in headers:
+                # Retry the plain envelope immediately, within the same
+                # attempt, so the fallback never consumes a retry slot.
+                body, headers = soap_body, HEADERS
+                response = await client.post(URL, content=body, headers=headers)
+            if response.status_code in (502, 503, 504) and attempt < 2:
+                await asyncio.sleep(0.3 * 2 ** attempt)
+                continue
+            response.raise_for_status()
+            break
+    match = _B64_RE.search(response.content)
+    if match is None or not match.group(1).strip():
+        return None
+    decoded = base64.b64decode(match.group(1))
+    _CACHE.set(cache_key, decoded, expire=86400)
+    return decoded
 
+async def _fetch_all(rssd_ids: list, period_end_date: str, username: str, passphrase: str) -> list:
+    # One event loop, one HTTP/2-capable client: N SOAP requests multiplex
+    # over a handful of connections instead of queueing, bounded by the
+    # semaphore. Exceptions come back in-place so one failed ID doesn't
+    # sink the batch.
+    limits = httpx.Limits(max_connections=MAX_CONCURRENCY, max_keepalive_connections=MAX_CONCURRENCY)
+    timeout = httpx.Timeout(60.0, connect=5.0)
+    async with httpx.AsyncClient(http2=True, limits=limits, timeout=timeout) as client:
+        sem = asyncio.Semaphore(MAX_CONCURRENCY)
+        return await asyncio.gather(
+            *(_fetch_one(client, sem, rssd_id, period_end_date, username, passphrase)
+              for rssd_id in rssd_ids),
+            return_exceptions=True
+        )
+
+# XBRL documents reuse the same few hundred tag names across tens of
+# thousands of facts, so the Clark-notation/prefix strip is memoized
+# instead of re-splitting the string for every element.
+_LOCALNAMES = {}
+
+def _localname(tag: str) -> str:
+    name = _LOCALNAMES.get(tag)
+    if name is None:
+        name = _LOCALNAMES.setdefault(tag, tag.rsplit("}", 1)[-1].split(":")[-1])
+    return name
+
+def parse_xbrl_to_dataframe(content: bytes, rssd_id: str) -> pd.DataFrame:
+    # Stream-parse the XBRL instead of building a full BeautifulSoup tree:
+    # only fact elements (those carrying a "decimals" attribute) are kept,
+    # and processed subtrees are freed as soon as they have been read.
+    ids, values, decimals_list = [], [], []
+    for _, elem in etree.iterparse(io.BytesIO(content), events=("end",), huge_tree=True):
+        decimals = elem.get("decimals")
+        if decimals is not None:
+            ids.append(_localname(elem.tag))
+            values.append((elem.text or "").strip())
+            decimals_list.append(decimals)
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+    if not ids:
+        raise ValueError("No XBRL facts found in the file!")
+    # Column-at-a-time construction: no per-row dicts to hash and no dtype
+    # inference pass. The constant rssd_id column is a single-category
+    # Categorical rather than N copies of the same string. "decimal" stays
+    # the raw attribute string: XBRL allows decimals="INF", which a numeric
+    # conversion would mangle into float inf. Arrow-backed dtypes keep the
+    # string columns compact and make the CSV export zero-copy.
+    return pd.DataFrame({
+        "rssd_id": pd.Categorical([rssd_id] * len(ids)),
+        "id": ids,
+        "value": values,
+        "decimal": decimals_list
+    }).convert_dtypes(dtype_backend="pyarrow")
+
+@st.cache_data(ttl=3600, show_spinner=False)
 def get_mapping_dict():
     mdrm_df = pd.read_csv(
         "downloads/taxonomy/MDRM/MDRM_CSV.csv",
         skiprows=1,
-        dtype={"Mnemonic": str, "Item Code": str}
+        dtype={"Mnemonic": str, "Item Code": str},
+        dtype_backend="pyarrow"
     )
-    mdrm_df["metric"] = mdrm_df["Mnemonic"].str.strip() + mdrm_df["Item Code"].str.zfill(4)
-    return pd.Series(mdrm_df["Item Name"].values, index=mdrm_df["metric"]).to_dict()
+    # Build the metric keys with numpy char ops rather than two pandas .str
+    # passes, and go straight to a dict without an intermediate Series.
+    # Blank/footer rows must go first: to_numpy(dtype=str) on an NA-capable
+    # string column collapses to a width-1 array and corrupts every key, so
+    # convert via object instead.
+    mdrm_df = mdrm_df.dropna(subset=["Mnemonic", "Item Code"])
+    mnemonic = mdrm_df["Mnemonic"].to_numpy(dtype=object).astype(str)
+    item_code = np.char.zfill(mdrm_df["Item Code"].to_numpy(dtype=object).astype(str), 4)
+    keys = np.char.add(np.char.strip(mnemonic), item_code)
+    return dict(zip(keys.tolist(), mdrm_df["Item Name"].to_numpy().tolist()))
 
-def process_rssd_id(rssd_id: str, period_end_date: str, username: str, passphrase: str) -> pd.DataFrame:
+def write_facts_csv(writer, rssd_id: str, payload: bytes, mapping_dict: dict) -> None:
+    # CSV-only path: stream one report's facts straight to the csv writer,
+    # labels included, without ever materializing a DataFrame.
+    for _, elem in etree.iterparse(io.BytesIO(payload), events=("end",), huge_tree=True):
+        decimals = elem.get("decimals")
+        if decimals is not None:
+            fact_id = _localname(elem.tag)
+            writer.writerow((rssd_id, fact_id, (elem.text or "").strip(), decimals,
+                             mapping_dict.get(fact_id, "Unknown metric")))
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+def _parse_one(item: tuple) -> tuple:
+    # Top-level so it can be dispatched to worker processes. Takes
+    # (rssd_id, payload bytes) and returns (DataFrame, None) on success or
+    # (None, error message) for the caller to emit.
+    rssd_id, payload = item
     try:
-        soap_body = make_soap_body(int(rssd_id), period_end_date, username, passphrase)
-        response = fetch_facsimile(URL, HEADERS, soap_body)
-        namespaces = {
-            "soap": "http://schemas.xmlsoap.org/soap/envelope/",
-            "ns": "http://cdr.ffiec.gov/public/services"
-        }
-        root = ET.fromstring(response.text)
-        result = root.find(".//ns:RetrieveFacsimileResult", namespaces)
-        if result is None or not result.text:
-            st.warning(f"No data found for RSSD ID: {rssd_id}")
-            return None
-        decoded = base64.b64decode(result.text).decode('utf-8')
-        return parse_xbrl_to_dataframe(decoded, rssd_id)
+        return parse_xbrl_to_dataframe(payload, rssd_id), None
     except Exception as e:
-        st.error(f"Error processing RSSD ID {rssd_id}: {str(e)}")
-        return None
+        return None, f"Error processing RSSD ID {rssd_id}: {str(e)}"
 
 def main():
     st.title("Call Report Downloader 📄")
@@ -145,37 +254,129 @@ def main():
         format="YYYY/MM/DD"
     )
 
+    show_preview = st.checkbox(
+        "Show data preview",
+        value=True,
+        help="Uncheck to skip the on-screen tables and stream straight to the CSV download (faster for large batches)"
+    )
+
     if st.button("🔄 Download Call Reports"):
         try:
             formatted_date = period_end_date.strftime("%Y/%m/%d")
-            rssd_ids = [id.strip() for id in rssd_ids_input.split(',') if id.strip()]
+            # Clean and validate the ID list in vectorized numpy passes so
+            # pasted lists of thousands of IDs don't stall the UI, and bad
+            # entries are reported together instead of failing one by one.
+            id_arr = np.char.strip(np.array(rssd_ids_input.split(','), dtype=str))
+            id_arr = id_arr[id_arr != ""]
 
-            if not rssd_ids:
+            if id_arr.size == 0:
                 st.error("Please enter at least one RSSD ID")
                 return
 
+            invalid = id_arr[~np.char.isdigit(id_arr)]
+            if invalid.size:
+                st.error(f"Invalid RSSD IDs (must be numeric): {', '.join(invalid.tolist())}")
+                return
+
+            rssd_ids = id_arr.tolist()
+
             all_dfs = []
+            messages = []
             progress_bar = st.progress(0)
             status_text = st.empty()
 
-            for i, rssd_id in enumerate(rssd_ids):
-                status_text.text(f"Processing RSSD ID: {rssd_id}")
-                df = process_rssd_id(rssd_id, formatted_date, username, passphrase)
-                if df is not None:
+            # The fetches are I/O-bound, so they all overlap on one event
+            # loop; the CPU-bound parsing runs afterwards over the collected
+            # payloads.
+            status_text.text(f"Fetching {len(rssd_ids)} call report(s)...")
+            payloads = asyncio.run(_fetch_all(rssd_ids, formatted_date, username, passphrase))
+
+            to_parse = []
+            for rssd_id, payload in zip(rssd_ids, payloads):
+                if isinstance(payload, Exception):
+                    messages.append(("error", f"Error processing RSSD ID {rssd_id}: {payload}"))
+                elif payload is None:
+                    messages.append(("warning", f"No data found for RSSD ID: {rssd_id}"))
+                else:
+                    to_parse.append((rssd_id, payload))
+
+            # Without a preview there is nothing to display, so skip pandas
+            # entirely and stream facts to the CSV as they are parsed.
+            if not show_preview:
+                try:
+                    mapping_dict = get_mapping_dict()
+                except FileNotFoundError:
+                    messages.append(("warning", "MDRM mapping file not found. Labels will be \"Unknown metric\"."))
+                    mapping_dict = {}
+
+                csv_buf = io.StringIO()
+                writer = csv.writer(csv_buf)
+                writer.writerow(("rssd_id", "id", "value", "decimal", "label"))
+                wrote_any = False
+                for i, (rssd_id, payload) in enumerate(to_parse):
+                    status_text.text(f"Writing RSSD ID: {rssd_id}")
+                    try:
+                        write_facts_csv(writer, rssd_id, payload, mapping_dict)
+                        wrote_any = True
+                    except Exception as e:
+                        messages.append(("error", f"Error processing RSSD ID {rssd_id}: {str(e)}"))
+                    progress_bar.progress((i + 1) / len(to_parse))
+
+                for level, message in messages:
+                    getattr(st, level)(message)
+
+                if not wrote_any:
+                    st.error("No data was retrieved for any RSSD ID.")
+                    return
+
+                st.download_button(
+                    label="📂 Download CSV",
+                    data=csv_buf.getvalue(),
+                    file_name=f"call_reports_{formatted_date.replace('/', '_')}.csv",
+                    mime="text/csv"
+                )
+                return
+
+            # Parsing is CPU-bound, so batches are spread across worker
+            # processes; a single report is parsed inline to skip the
+            # fork/pickle overhead.
+            status_text.text(f"Parsing {len(to_parse)} call report(s)...")
+            if len(to_parse) > 1:
+                with ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, len(to_parse))) as pool:
+                    results = list(pool.map(_parse_one, to_parse))
+            else:
+                results = [_parse_one(item) for item in to_parse]
+
+            for i, (df, error) in enumerate(results):
+                if error is not None:
+                    messages.append(("error", error))
+                elif df is not None:
                     all_dfs.append(df)
-                progress_bar.progress((i + 1) / len(rssd_ids))
+                progress_bar.progress((i + 1) / len(to_parse))
+
+            for level, message in messages:
+                getattr(st, level)(message)
 
             if not all_dfs:
                 st.error("No data was retrieved for any RSSD ID.")
                 return
 
-            combined_df = pd.concat(all_dfs, ignore_index=True)
+            # Every frame from parse_xbrl_to_dataframe shares the same column
+            # order and dtypes, so a single unsorted concat takes the
+            # block-wise fast path (copy-on-write avoids an eager copy).
+            combined_df = pd.concat(all_dfs, ignore_index=True, sort=False)
             st.subheader("📈 Raw Data")
             st.dataframe(combined_df)
 
             try:
                 mapping_dict = get_mapping_dict()
-                combined_df["label"] = combined_df["id"].map(mapping_dict).fillna("Unknown metric")
+                # Integer-coded join instead of a per-row dict lookup: look up
+                # the id column against the mapping keys in one pass, then
+                # index the label array with the resulting codes (-1 marks ids
+                # missing from the MDRM).
+                labels_arr = np.array(list(mapping_dict.values()), dtype=object)
+                codes = pd.Index(mapping_dict.keys()).get_indexer(combined_df["id"])
+                combined_df["label"] = np.where(codes >= 0, labels_arr[codes.clip(min=0)], "Unknown metric")
                 st.subheader("📊 Mapped Data")
                 st.dataframe(combined_df)
             except FileNotFoundError:
@@ -183,10 +384,14 @@ def main():
                 st.subheader("Mapped Data (Mapping file not found)")
                 st.dataframe(combined_df)
 
-            csv = combined_df.to_csv(index=False)
+            # Serialize with Arrow's multi-threaded CSV writer into a bytes
+            # buffer rather than materializing the CSV as one Python string.
+            csv_buf = io.BytesIO()
+            pacsv.write_csv(pa.Table.from_pandas(combined_df, preserve_index=False), csv_buf,
+                            write_options=pacsv.WriteOptions(include_header=True))
             st.download_button(
                 label="📂 Download CSV",
-                data=csv,
+                data=csv_buf.getvalue(),
                 file_name=f"call_reports_{formatted_date.replace('/', '_')}.csv",
                 mime="text/csv"
             )